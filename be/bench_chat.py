@@ -0,0 +1,133 @@
+"""
+Load/save timings and peak memory of a synthetic notebook, comparing chatstore (slotted cells validated one
+at a time, one cell per line on disk) with the previous path (json module plus a pydantic model per message),
+the event loop stall while a chat loads in a thread, a save after one cell changed and the time to serve
+the first window of cells.
+
+run from the repo root with: python -m be.bench_chat [n_cells]
+"""
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+from tempfile import TemporaryDirectory
+from pydantic import BaseModel
+from . import mytypes
+from . import chatstore
+
+class LegacyMessage(BaseModel):
+    type: mytypes.MessageType
+    content: str
+    version: int = 1
+    id: int
+
+class LegacyCodeMessage(LegacyMessage):
+    output: list
+    execution_status: str
+
+def synthetic(n: int) -> bytes:
+    png = base64.b64encode(os.urandom(3_000)).decode()
+    messages = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            messages.append({"type": "text", "content": f"## section {i}\nsome notes", "version": 1, "id": i})
+        elif kind == 1:
+            messages.append({"type": "query", "content": f"why does cell {i-1} fail?", "version": 1, "id": i})
+        else:
+            output = [{"type": "stream", "content": {"name": "stdout", "text": f"step {j}\n"}} for j in range(5)]
+            if kind == 3:
+                output.append({"type": "data", "content": {"type": "image/png", "data": png}})
+            messages.append({
+                "type": "code", "content": f"x{i} = x{i-1} + 1\nprint(x{i})", "version": 1, "id": i,
+                "output": output, "execution_status": "done",
+            })
+    return json.dumps({"messages": messages}).encode()
+
+def legacy_load(raw: bytes):
+    chat = json.loads(raw)
+    return [
+        (LegacyCodeMessage if m["type"] == "code" else LegacyMessage).model_validate(m)
+        for m in chat["messages"]
+    ]
+
+def legacy_save(messages) -> bytes:
+    return json.dumps({"messages": [m.model_dump() for m in messages]}, indent=2, ensure_ascii=False).encode()
+
+def load(chat_id: str):
+    return chatstore.load_messages(chat_id)
+
+def save(messages) -> list:
+    # the part that runs on the event loop, writing is the same for both paths. Every cell is
+    # encoded, as when converting or renumbering a chat
+    for m in messages:
+        m.saved = None
+    plan = chatstore.encode(messages)
+    chatstore.saved(messages, plan, None)
+    return plan
+
+def resave(messages) -> float:
+    # event loop side of a save after one cell changed: the others are copied from the file by stage
+    messages[-1].saved = None
+    start = time.perf_counter()
+    plan = chatstore.encode(messages)
+    elapsed = time.perf_counter() - start
+    staged, spans = chatstore.stage("bench", plan)
+    chatstore.commit("bench", staged)
+    start = time.perf_counter()
+    chatstore.saved(messages, plan, spans)
+    return elapsed + time.perf_counter() - start
+
+async def load_stall(chat_id: str) -> float:
+    # longest the event loop waits for the GIL while the chat loads in a thread
+    loading = asyncio.create_task(asyncio.to_thread(chatstore.load_messages, chat_id))
+    longest = 0.0
+    last = time.perf_counter()
+    while not loading.done():
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        longest = max(longest, now - last)
+        last = now
+    return longest
+
+def first_window(chat_id: str) -> bytes:
+    return chatstore.read_window(chat_id, 0, 50, False)
+
+def measure(fn, arg):
+    # timed and traced separately, tracemalloc slows allocation heavy code a lot
+    start = time.perf_counter()
+    result = fn(arg)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    kept = fn(arg)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return result, elapsed, peak, retained
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    raw = synthetic(n)
+    print(f"{n} cells, {len(raw) / 1e6:.1f} MB")
+    # peak MB is the high water mark while running, kept MB what the loaded conversation holds on to
+    print(f"{'path':<8} {'load ms':>8} {'peak MB':>8} {'kept MB':>8} {'save ms':>8} {'peak MB':>8}")
+    with TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.mkdir("chats")
+        chatstore.chat_path("bench").write_bytes(raw)
+        chatstore.write_chat("bench", chatstore.load_messages("bench")) # converts it to the line format
+        for name, load_fn, save_fn, arg in [("legacy", legacy_load, legacy_save, raw), ("current", load, save, "bench")]:
+            messages, load_s, load_peak, kept = measure(load_fn, arg)
+            _, save_s, save_peak, _ = measure(save_fn, messages)
+            print(f"{name:<8} {load_s*1e3:>8.0f} {load_peak/1e6:>8.1f} {kept/1e6:>8.1f} {save_s*1e3:>8.0f} {save_peak/1e6:>8.1f}")
+        print(f"longest event loop stall while loading: {asyncio.run(load_stall('bench'))*1e3:.1f} ms")
+        chatstore.write_chat("bench", messages)
+        print(f"event loop time of a save after one cell changed: {resave(messages)*1e3:.1f} ms")
+        _, window_s, window_peak, _ = measure(first_window, "bench")
+        print(f"first 50 cells: {window_s*1e3:.1f} ms, peak {window_peak/1e6:.1f} MB")
+
+if __name__ == "__main__":
+    main()
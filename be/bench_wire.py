@@ -0,0 +1,51 @@
+"""
+Compares bytes on the wire and encode cpu time of the json and msgpack protocols per output type.
+Deflate sizes approximate what permessage-deflate sends when the client negotiates it.
+
+run from the repo root with: python -m be.bench_wire
+"""
+import base64
+import os
+import time
+import zlib
+from . import wire
+
+N = 2000
+
+def sample_outputs() -> dict[str, dict]:
+    png = base64.b64encode(b"\x89PNG\r\n\x1a\n" + os.urandom(60_000)).decode()
+    base = {"id": 42, "result": "code execution"}
+    return {
+        "status": {**base, "type": "status", "content": "busy"},
+        "stream chunk": {**base, "type": "stream", "content": {"name": "stdout", "text": "epoch 3 loss 0.1234\n"}},
+        "stream large": {**base, "type": "stream", "content": {"name": "stdout", "text": "col_a\tcol_b\tcol_c\n" * 2000}},
+        "html table": {**base, "type": "data", "content": {"type": "text/html", "data": "<tr><td>1</td><td>\"x\"</td></tr>" * 500}},
+        "image/png": {**base, "type": "data", "content": {"type": "image/png", "data": png}},
+        "llm token": {"id": 43, "result": "generation success", "content": " the"},
+    }
+
+def deflated(frame: str | bytes) -> int:
+    if isinstance(frame, str):
+        frame = frame.encode()
+    # permessage-deflate strips the trailing 4 bytes of the sync flush
+    c = zlib.compressobj(wbits=-15)
+    return len(c.compress(frame) + c.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+def bench(msg: dict, protocol: wire.Protocol) -> tuple[int, int, float]:
+    frame = wire.encode(msg, protocol)
+    start = time.perf_counter()
+    for _ in range(N):
+        wire.encode(msg, protocol)
+    us = (time.perf_counter() - start) / N * 1e6
+    size = len(frame.encode()) if isinstance(frame, str) else len(frame)
+    return size, deflated(frame), us
+
+def main():
+    print(f"{'output':<14} {'protocol':<8} {'bytes':>9} {'deflated':>9} {'encode us':>10}")
+    for name, msg in sample_outputs().items():
+        for protocol in ("json", "msgpack"):
+            size, dsize, us = bench(msg, protocol)
+            print(f"{name:<14} {protocol:<8} {size:>9} {dsize:>9} {us:>10.1f}")
+
+if __name__ == "__main__":
+    main()
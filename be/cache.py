@@ -0,0 +1,128 @@
+import json
+import os
+import time
+from pathlib import Path
+
+# opt in: the cache is off unless a size budget is set
+CACHE_DIR = Path(os.getenv("EXEC_CACHE_DIR", "exec_cache"))
+MAX_BYTES = int(os.getenv("EXEC_CACHE_MB", "0")) * 1024 * 1024
+# a checkpoint still being written after this long belongs to a kernel that died mid dump
+STALE_TMP_SECONDS = 600
+
+# runs inside the kernel. dill handles functions and classes defined in the notebook, plain pickle
+# only stores them by reference so restoring them fails and the cell is re-run instead
+_DUMP = """
+def __nb_cache_dump(path, names, g):
+    import os, pickle, types
+    try:
+        import dill as pickle
+    except ImportError:
+        pass
+    state = {}
+    for name in names:
+        if name not in g:
+            continue
+        value = g[name]
+        if isinstance(value, types.ModuleType):
+            state[name] = ("module", value.__name__)
+        else:
+            state[name] = ("value", value)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f)
+    except BaseException:
+        # unpicklable values (generators, open files...) fail halfway, the cell is just not cached
+        os.remove(tmp)
+        raise
+    os.replace(tmp, path)
+try:
+    __nb_cache_dump(%r, %r, globals())
+finally:
+    del __nb_cache_dump
+"""
+
+_LOAD = """
+def __nb_cache_load(path, g):
+    import importlib, pickle
+    try:
+        import dill as pickle
+    except ImportError:
+        pass
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    for name, (kind, value) in state.items():
+        g[name] = importlib.import_module(value) if kind == "module" else value
+try:
+    __nb_cache_load(%r, globals())
+finally:
+    del __nb_cache_load
+"""
+
+class ExecCache:
+    """
+    On disk cache of cell outputs and of the variables they define, keyed by DepGraph.key.
+    Each entry is {key}.pkl (written by the kernel) and {key}.json (outputs), least recently used entries
+    are evicted once the directory grows past max_bytes.
+    """
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, key: str) -> tuple[Path, Path]:
+        return self.root / f"{key}.pkl", self.root / f"{key}.json"
+
+    def get(self, key: str) -> list | None:
+        state, outputs = self._paths(key)
+        if not (state.is_file() and outputs.is_file()):
+            return None
+        with outputs.open() as f:
+            result = json.load(f)
+        # mtime is the recency used for eviction
+        state.touch()
+        outputs.touch()
+        return result
+
+    def put(self, key: str, outputs: list):
+        state, outputs_path = self._paths(key)
+        if not state.is_file():
+            return
+        with outputs_path.open("w") as f:
+            json.dump(outputs, f)
+        self.evict()
+
+    def evict(self):
+        entries: dict[str, list[os.stat_result]] = {}
+        total = 0
+        for f in self.root.iterdir():
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue # evicted or renamed by another session meanwhile
+            if f.suffix == ".tmp":
+                if time.time() - stat.st_mtime > STALE_TMP_SECONDS:
+                    f.unlink(missing_ok=True)
+                else:
+                    total += stat.st_size
+            elif f.suffix in (".pkl", ".json"):
+                entries.setdefault(f.stem, []).append(stat)
+                total += stat.st_size
+        by_age = sorted(entries, key=lambda k: max(s.st_mtime for s in entries[k]))
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            total -= sum(s.st_size for s in entries[key])
+            for path in self._paths(key):
+                path.unlink(missing_ok=True)
+
+    def dump_code(self, key: str, names: set[str]) -> str:
+        return _DUMP % (str(self._paths(key)[0].resolve()), sorted(names))
+
+    def load_code(self, key: str) -> str:
+        return _LOAD % (str(self._paths(key)[0].resolve()),)
+
+def create() -> ExecCache | None:
+    if MAX_BYTES <= 0:
+        return None
+    return ExecCache(CACHE_DIR, MAX_BYTES)
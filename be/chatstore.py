@@ -0,0 +1,303 @@
+import json
+import os
+import struct
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Iterable, Iterator
+from . import mytypes
+
+# chat files are still a single json document, but with one cell per line so they can be read
+# incrementally and sliced by byte offset:
+# {"messages":[
+# {...cell 0...},
+# {...cell 1...}
+# ]}
+HEADER = b'{"messages":[\n'
+FOOTER = b']}\n'
+
+CHAT_DIR = Path("chats")
+# directories, so /recent (which lists the files in CHAT_DIR) doesn't pick them up
+INDEX_DIR = CHAT_DIR / ".index"
+TMP_DIR = CHAT_DIR / ".tmp"
+
+# the index is fixed size records, so any window of cells is a single seek whatever the chat size.
+# Its header is the size and mtime of the chat file it describes, which tells a stale index apart
+_INDEX_HEADER = struct.Struct("<Qq")
+# offset, length, id, version, number of outputs, type, execution status
+_RECORD = struct.Struct("<QQqIIBB")
+# written as the byte range of the cell plus the rest, which only changes with the cell and is cached with it
+_SPAN = struct.Struct("<QQ")
+_TAIL = struct.Struct("<qIIBB")
+_TYPES = list(mytypes.MessageType)
+_STATUSES = ["pending", "started", "done"]
+_TYPE_CODES: dict[str, int] = {t: i for i, t in enumerate(_TYPES)}
+_STATUS_CODES = {s: i for i, s in enumerate(_STATUSES)}
+
+# a cell in a save plan: the json of a changed cell, or where an unchanged one is in the current file
+Encoded = tuple[bytes, bytes] # json, record tail
+Span = tuple[int, int, bytes] # offset, length, record tail
+
+def chat_path(chat_id: str) -> Path:
+    return CHAT_DIR / f"{chat_id}.json"
+
+def index_path(chat_id: str) -> Path:
+    return INDEX_DIR / f"{chat_id}.idx"
+
+def _tail(cell: mytypes.Message | dict) -> bytes:
+    msg = mytypes.CellAdapter.validate_python(cell) if isinstance(cell, dict) else cell
+    outputs, status = 0, 0
+    if isinstance(msg, mytypes.CodeMessage):
+        outputs, status = len(msg.output), _STATUS_CODES[msg.execution_status]
+    return _TAIL.pack(msg.id, msg.version, outputs, _TYPE_CODES[msg.type], status)
+
+def _meta(record: tuple) -> dict:
+    """what the client needs to lay out a cell before fetching its body"""
+    _offset, _length, id, version, outputs, type, status = record
+    meta = {"id": id, "type": _TYPES[type], "version": version}
+    if meta["type"] == mytypes.MessageType.CODE:
+        meta["execution_status"] = _STATUSES[status]
+        meta["outputs"] = outputs
+    return meta
+
+def encode(messages: list[mytypes.Message]) -> list[Encoded | Span]:
+    """
+    The save plan of the chat. Runs on the event loop, which keeps the conversation from changing underneath it:
+    only cells changed since the last save are encoded, the others are copied from the current file by stage.
+    Cells are marked as being saved until saved is called with the outcome.
+    """
+    plan = []
+    for msg in messages:
+        if msg.saved is None:
+            if isinstance(msg, mytypes.CodeMessage):
+                msg.pack_output()
+            msg.saved = (mytypes.CellAdapter.dump_json(msg), _tail(msg))
+        plan.append(msg.saved)
+    return plan
+
+def saved(messages: list[mytypes.Message], plan: list[Encoded | Span], spans: list[Span] | None):
+    """
+    Back on the event loop once a save is committed (spans from stage) or failed (None). Cells that didn't
+    change meanwhile learn where they are in the file, after a failure every cell is encoded again next time
+    since it's unknown which file is in place.
+    """
+    for msg, entry, span in zip(messages, plan, spans or [None] * len(plan)):
+        if msg.saved is entry:
+            msg.saved = span
+
+def _stage(parts: Iterable[bytes]) -> Path:
+    # a temp file of its own, concurrent writers of the same file would otherwise clobber each other's
+    TMP_DIR.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile("wb", dir=TMP_DIR, delete=False) as f:
+        try:
+            f.writelines(parts)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    return Path(f.name)
+
+def _replace(path: Path, parts: list[bytes]):
+    # replaced rather than rewritten in place, readers holding the old file keep a consistent copy
+    tmp = _stage(parts)
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+def _write_index(chat_id: str, stat: os.stat_result, records: list[bytes]):
+    INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    _replace(index_path(chat_id), [_INDEX_HEADER.pack(stat.st_size, stat.st_mtime_ns), *records])
+
+def _index_matches(index, stat: os.stat_result) -> bool:
+    header = index.read(_INDEX_HEADER.size)
+    return len(header) == _INDEX_HEADER.size and _INDEX_HEADER.unpack(header) == (stat.st_size, stat.st_mtime_ns)
+
+def _parts(chat_id: str, plan: list[Encoded | Span], spans: list[Span]) -> Iterator[bytes]:
+    current = None
+    try:
+        yield HEADER
+        offset = len(HEADER)
+        for i, entry in enumerate(plan):
+            if len(entry) == 2:
+                body, tail = entry
+            else:
+                if current is None:
+                    # unchanged cells come from the file the last save wrote, only the owner replaces it
+                    current = chat_path(chat_id).open("rb")
+                start, length, tail = entry
+                current.seek(start)
+                body = current.read(length)
+            sep = b",\n" if i < len(plan) - 1 else b"\n"
+            spans.append((offset, len(body), tail))
+            yield body
+            yield sep
+            offset += len(body) + len(sep)
+        yield FOOTER
+    finally:
+        if current is not None:
+            current.close()
+
+def stage(chat_id: str, plan: list[Encoded | Span]) -> tuple[tuple[Path, Path], list[Span]]:
+    """
+    Blocking, run it in a thread. Writes the chat and its index to temp files, commit moves them in place
+    so the slow part can happen outside of a fence. Renaming keeps size and mtime, the index header stays valid.
+    Also returns where each cell ended up, for saved.
+    """
+    spans: list[Span] = []
+    chat = _stage(_parts(chat_id, plan, spans))
+    try:
+        stat = chat.stat()
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        index = _stage([_INDEX_HEADER.pack(stat.st_size, stat.st_mtime_ns), *(_SPAN.pack(o, l) + t for o, l, t in spans)])
+    except BaseException:
+        chat.unlink(missing_ok=True)
+        raise
+    return (chat, index), spans
+
+def commit(chat_id: str, staged: tuple[Path, Path]):
+    chat, index = staged
+    os.replace(chat, chat_path(chat_id))
+    os.replace(index, index_path(chat_id))
+
+def discard(staged: tuple[Path, Path]):
+    """removes what commit didn't move"""
+    for path in staged:
+        path.unlink(missing_ok=True)
+
+def write_chat(chat_id: str, messages: list[mytypes.Message]):
+    """blocking, for chats no session holds (new ones)"""
+    plan = encode(messages)
+    spans = None
+    try:
+        staged, new_spans = stage(chat_id, plan)
+        try:
+            commit(chat_id, staged)
+        finally:
+            discard(staged)
+        spans = new_spans
+    finally:
+        saved(messages, plan, spans)
+
+def is_line_format(chat_id: str) -> bool:
+    """false for chat files written before the line format, they're converted by the next save"""
+    with chat_path(chat_id).open("rb") as f:
+        return f.readline() == HEADER
+
+_SEPARATORS = " \t\r\n,"
+
+def _scan_legacy(data: bytes) -> Iterator[tuple[int, bytes]]:
+    # the older format is indented json, cells are found by decoding them one at a time
+    text = data.decode()
+    decoder = json.JSONDecoder()
+    char = text.index("[", text.index('"messages"')) + 1
+    offset = len(text[:char].encode())
+    while True:
+        start = char
+        while text[start] in _SEPARATORS:
+            start += 1
+        offset += len(text[char:start].encode())
+        if text[start] == "]":
+            return
+        _, char = decoder.raw_decode(text, start)
+        length = len(text[start:char].encode())
+        yield offset, data[offset:offset+length]
+        offset += length
+
+def _scan(f: BinaryIO) -> Iterator[tuple[int, bytes]]:
+    """yields (offset, json) of each cell of an open chat file, either format"""
+    f.seek(0)
+    first = f.readline()
+    if first != HEADER:
+        f.seek(0)
+        yield from _scan_legacy(f.read())
+        return
+    offset = len(first)
+    for line in f:
+        if line == FOOTER:
+            break
+        yield offset, line.rstrip(b"\n").removesuffix(b",")
+        offset += len(line)
+
+def load_messages(chat_id: str) -> list[mytypes.Message] | None:
+    """
+    Blocking, run it in a thread. Cells are parsed one at a time, so the GIL goes back to the event loop in
+    between, and those of a line format file remember where they are in it.
+    """
+    try:
+        f = chat_path(chat_id).open("rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        line_format = f.readline() == HEADER
+        messages = []
+        # the json module and validate_python, faster than pydantic's own parser on big string outputs
+        for offset, body in _scan(f):
+            msg = mytypes.CellAdapter.validate_python(json.loads(body))
+            if line_format:
+                msg.saved = (offset, len(body), _tail(msg))
+            messages.append(msg)
+    return messages
+
+def ensure_index(chat_id: str) -> bool:
+    """
+    Blocking, run it in a thread. Rebuilds a stale index, one cell at a time. The index is derived from the
+    chat file and tells a stale copy apart, so any worker can rebuild it, while the chat file itself is only
+    written by the owner of the chat (older format files are indexed as they are). False if the chat doesn't exist.
+    """
+    try:
+        f = chat_path(chat_id).open("rb")
+    except FileNotFoundError:
+        return False
+    with f:
+        # the header describes the file that was scanned, whatever got saved since
+        stat = os.fstat(f.fileno())
+        try:
+            with index_path(chat_id).open("rb") as index:
+                if _index_matches(index, stat):
+                    return True
+        except FileNotFoundError:
+            pass
+
+        records = [_SPAN.pack(offset, len(body)) + _tail(json.loads(body)) for offset, body in _scan(f)]
+    _write_index(chat_id, stat, records)
+    return True
+
+def _window(chat_id: str, total: int, start: int, cells: list[dict], bodies: list[bytes], meta_only: bool) -> bytes:
+    head = json.dumps({"id": chat_id, "total": total, "start": start, "cells": cells}).encode()
+    if meta_only:
+        return head
+    return head[:-1] + b',"messages":[' + b",".join(bodies) + b"]}"
+
+def read_window(chat_id: str, start: int, limit: int, meta_only: bool) -> bytes | None:
+    """
+    Blocking, run it in a thread. Json response with the metadata of cells [start, start+limit) and,
+    unless meta_only, their bodies sliced straight out of the chat file.
+    """
+    while True:
+        if not ensure_index(chat_id):
+            return None
+        with chat_path(chat_id).open("rb") as f, index_path(chat_id).open("rb") as index:
+            if not _index_matches(index, os.fstat(f.fileno())):
+                continue # the chat was saved in between, the index is for another file
+
+            total = (os.fstat(index.fileno()).st_size - _INDEX_HEADER.size) // _RECORD.size
+            start = min(start, total)
+            index.seek(_INDEX_HEADER.size + start * _RECORD.size)
+            window = list(_RECORD.iter_unpack(index.read(min(limit, total - start) * _RECORD.size)))
+            bodies = []
+            if not meta_only:
+                for offset, length, *_ in window:
+                    f.seek(offset)
+                    bodies.append(f.read(length))
+            break
+
+    return _window(chat_id, total, start, [_meta(record) for record in window], bodies, meta_only)
+
+def stream_chat(chat_id: str) -> Iterator[bytes]:
+    """the whole chat as {"id": ..., "messages": [...]} straight from disk"""
+    # both formats start with the "{" replaced here
+    with chat_path(chat_id).open("rb") as f:
+        yield json.dumps({"id": chat_id})[:-1].encode() + b","
+        f.seek(1)
+        while chunk := f.read(1 << 16):
+            yield chunk
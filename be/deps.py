@@ -0,0 +1,175 @@
+import ast
+import hashlib
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+# nodes whose bodies have their own scope, assignments inside don't define notebook level names
+_NAMED_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+_SCOPES = (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+def _is_magic(line: str) -> bool:
+    return line.lstrip().startswith(("%", "!"))
+
+def has_magics(code: str) -> bool:
+    return any(_is_magic(l) for l in code.splitlines())
+
+def _strip_magics(code: str) -> str:
+    # ipython magics and shell escapes aren't valid python, blank them to keep line numbers
+    return "\n".join("" if _is_magic(l) else l for l in code.splitlines())
+
+def _base_name(node: ast.expr) -> str | None:
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+def _top_level_defs(stmt: ast.stmt, defs: set[str]):
+    todo: list[ast.AST] = [stmt]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, _NAMED_SCOPES):
+            defs.add(node.name)
+            continue
+        if isinstance(node, _SCOPES):
+            continue
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            defs.add(node.id)
+        elif isinstance(node, (ast.Attribute, ast.Subscript)) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            # df["a"] = 1 mutates df, so readers of df are affected too
+            name = _base_name(node)
+            if name is not None:
+                defs.add(name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                defs.add(alias.asname or alias.name.split(".")[0])
+        todo.extend(ast.iter_child_nodes(node))
+
+def analyse(code: str) -> tuple[set[str], set[str]]:
+    """
+    Returns the top level names a cell defines and the names it reads.
+    Reads are over approximated (names used inside functions count too), which at worst marks extra cells stale.
+    Cells that don't parse define and use nothing.
+    """
+    try:
+        tree = ast.parse(_strip_magics(code))
+    except SyntaxError:
+        return set(), set()
+
+    defs: set[str] = set()
+    for stmt in tree.body:
+        _top_level_defs(stmt, defs)
+    uses = {n.id for n in ast.walk(tree) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+    return defs, uses
+
+class CellNode:
+    __slots__ = ("id", "defs", "uses", "magics", "code_hash")
+
+    def __init__(self, id: int, code: str):
+        self.id = id
+        self.defs, self.uses = analyse(code)
+        self.magics = has_magics(code)
+        self.code_hash = hashlib.sha256(code.encode()).hexdigest()
+
+class DepGraph:
+    """
+    Def/use graph over the code cells of a notebook. Cell ids grow with notebook order, so a cell reading `x`
+    depends on the closest earlier cell defining `x`, and notebook order is always a topological order.
+    Indexes are per name, so adding or editing a cell only touches the names it defines or reads.
+    """
+    def __init__(self):
+        self.cells: dict[int, CellNode] = {}
+        self.definers: dict[str, list[int]] = defaultdict(list) # sorted cell ids
+        self.readers: dict[str, set[int]] = defaultdict(set)
+        self.stale: set[int] = set()
+
+    def _index(self, node: CellNode):
+        for name in node.defs:
+            insort(self.definers[name], node.id)
+        for name in node.uses:
+            self.readers[name].add(node.id)
+
+    def _unindex(self, node: CellNode):
+        for name in node.defs:
+            self.definers[name].remove(node.id)
+        for name in node.uses:
+            self.readers[name].discard(node.id)
+
+    def _definer_before(self, name: str, cell_id: int) -> int | None:
+        ids = self.definers.get(name, [])
+        i = bisect_left(ids, cell_id)
+        return ids[i-1] if i > 0 else None
+
+    def upstream(self, cell_id: int) -> set[int]:
+        result = set()
+        for name in self.cells[cell_id].uses:
+            definer = self._definer_before(name, cell_id)
+            if definer is not None:
+                result.add(definer)
+        return result
+
+    def _readers_of(self, cell_id: int, names: set[str]) -> set[int]:
+        result = set()
+        for name in names:
+            for reader in self.readers.get(name, ()):
+                if reader > cell_id and self._definer_before(name, reader) == cell_id:
+                    result.add(reader)
+        return result
+
+    def downstream(self, cell_id: int) -> set[int]:
+        """cells that (transitively) read names defined by cell_id"""
+        result = set()
+        todo = [cell_id]
+        while todo:
+            current = todo.pop()
+            for reader in self._readers_of(current, self.cells[current].defs):
+                if reader not in result:
+                    result.add(reader)
+                    todo.append(reader)
+        return result
+
+    def add(self, cell_id: int, code: str, stale: bool = False):
+        """new cells go at the end of the notebook, so nothing downstream changes"""
+        node = CellNode(cell_id, code)
+        self.cells[cell_id] = node
+        self._index(node)
+        if stale:
+            self.stale.add(cell_id)
+
+    def update(self, cell_id: int, code: str) -> set[int]:
+        """
+        Re-analyses an edited cell. The cell, every cell that read its old or new definitions and their
+        downstream become stale. Returns the newly stale ids.
+        """
+        old = self.cells[cell_id]
+        # readers of the old defs are computed before reindexing, they may lose the edge
+        affected = self._readers_of(cell_id, old.defs)
+        self._unindex(old)
+        node = CellNode(cell_id, code)
+        self.cells[cell_id] = node
+        self._index(node)
+
+        affected.add(cell_id)
+        for changed in list(affected):
+            affected |= self.downstream(changed)
+        newly = affected - self.stale
+        self.stale |= affected
+        return newly
+
+    def key(self, cell_id: int, _memo: dict[int, str] | None = None) -> str:
+        """hash of the cell code and of the keys of the cells it reads from, changes whenever any input does"""
+        memo = {} if _memo is None else _memo
+        if cell_id not in memo:
+            h = hashlib.sha256(self.cells[cell_id].code_hash.encode())
+            for up in sorted(self.upstream(cell_id)):
+                h.update(self.key(up, memo).encode())
+            memo[cell_id] = h.hexdigest()
+        return memo[cell_id]
+
+    def scheduled(self, cell_id: int):
+        """
+        The cell was queued to run with its current code. Cleared now rather than once it ran, an edit while it
+        runs marks it stale again and a second run_stale doesn't queue it twice.
+        """
+        self.stale.discard(cell_id)
+
+    def stale_order(self) -> list[int]:
+        return sorted(self.stale)
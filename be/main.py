@@ -1,7 +1,8 @@
 import os
 import json
 import httpx
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from . import mytypes
 import asyncio
@@ -11,13 +12,21 @@ from itertools import groupby
 from datetime import datetime
 from uuid import uuid4
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-import shutil
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import websockets
 from . import lsp
+from . import wire
+from . import deps
+from . import cache
+from . import scheduler
+from . import chatstore
+from . import sessions
 
 active_lsp = {}
+exec_cache = cache.create()
 with open("/usr/share/dict/words") as f:
     words = [l.strip() for l in f.readlines()]
 
@@ -29,6 +38,10 @@ if router_key is None:
     print('hi')
     raise ValueError("empty router key")
 # "openai/gpt-4o"
+generations = scheduler.GenerationScheduler(
+    int(os.getenv("MAX_CONCURRENT_GENERATIONS", "4")),
+    int(os.getenv("GENERATION_TPM", "0")), # 0 is no limit
+)
 
 origins = ["http://localhost:5173", "ws://localhost:5173"]
 app = FastAPI()
@@ -43,12 +56,21 @@ async def ack(tmp_id: str, msg_id: int, queue: asyncio.Queue):
     content = {"result": "created", "tmpID": tmp_id, "id": msg_id}
     await queue.put(content)
 
-async def generate(query: list[dict[str,str]], msg_id: int, queue: asyncio.Queue):
+async def generate(query: list[dict[str,str]], msg_id: int, queue: asyncio.Queue, chat_id: str):
     fname = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".json"
     response = ""
-    async for part in invoke_streaming_llm(query):
-        response += part
-        await queue.put({"id": msg_id, "result": "generation success", "content": part})
+    try:
+        async with generations.slot(chat_id, scheduler.estimate_tokens(json.dumps(query))) as slot:
+            print(f"generation {chat_id}/{msg_id} waited {slot.wait:.3f}s in queue")
+            await queue.put({"id": msg_id, "result": "generation started", "queue_wait": slot.wait})
+            async for part in invoke_streaming_llm(query):
+                slot.charge(scheduler.estimate_tokens(part))
+                response += part
+                await queue.put({"id": msg_id, "result": "generation success", "content": part})
+    except asyncio.CancelledError:
+        # leaving the stream context closes the connection to openrouter
+        await queue.put({"id": msg_id, "result": "generation cancelled"})
+        raise
     query.append({"role": "assistant", "content": response})
     with open("llm_queries/"+fname, "w") as f:
         json.dump(query, f)
@@ -104,23 +126,73 @@ def parse_msg(msg: dict):
 
     return None
 
-def execute(code: str, id: str, kc: KernelClient, queue: asyncio.Queue, loop: asyncio.EventLoop):
-    _msg_id = kc.execute(code)
+def execute(code: str, id: str, kc: KernelClient, queue: asyncio.Queue, loop: asyncio.EventLoop) -> list[dict]:
+    outputs = []
+    msg_id = kc.execute(code)
     while True:
         try:
             msg = kc.get_iopub_msg(timeout=1)
         except (TimeoutError, Empty):
             continue
+        if msg["parent_header"].get("msg_id") != msg_id:
+            # left over from an earlier request, e.g. the status of a silent cache load/dump
+            continue
 
         out = parse_msg(msg)
         if out is None:
             continue
 
         print(out)
+        if out["type"] != "status":
+            outputs.append(dict(out))
         out.update({"id": id, "result": "code execution"})
         asyncio.run_coroutine_threadsafe(queue.put(out), loop)
         if out["type"] == "status" and out["content"] == "idle":
-            break
+            return outputs
+
+def run_silent(code: str, kc: KernelClient) -> bool:
+    msg_id = kc.execute(code, silent=True, store_history=False)
+    while True:
+        try:
+            reply = kc.get_shell_msg(timeout=1)
+        except (TimeoutError, Empty):
+            continue
+        # nobody else reads the shell channel, replies to earlier cells pile up there
+        if reply["parent_header"].get("msg_id") == msg_id:
+            return reply["content"]["status"] == "ok"
+
+def restore(outputs: list[dict], id: int, queue: asyncio.Queue, loop: asyncio.EventLoop):
+    # same messages a real execution sends, outputs are flagged so the fe can tell them apart
+    restored = [{**o, "restored": True} for o in outputs]
+    for out in [{"type": "status", "content": "busy"}, *restored, {"type": "status", "content": "idle"}]:
+        out.update({"id": id, "result": "code execution"})
+        asyncio.run_coroutine_threadsafe(queue.put(out), loop)
+
+def run_cell(cell: tuple[str, int, str | None, set[str], bool], kc: KernelClient, queue: asyncio.Queue, loop: asyncio.EventLoop):
+    """
+    Executes a cell and checkpoints the variables it defined after a clean run, unless key is None (cache off
+    or a cell that can't be cached). With lookup set, a hit loads them instead of running the cell.
+    """
+    code, id, key, defs, lookup = cell
+    if key is None:
+        execute(code, id, kc, queue, loop)
+        return
+
+    outputs = exec_cache.get(key) if lookup else None
+    if outputs is not None and run_silent(exec_cache.load_code(key), kc):
+        restore(outputs, id, queue, loop)
+        return
+
+    outputs = execute(code, id, kc, queue, loop)
+    if any(o["type"] == "error" for o in outputs):
+        return
+    if run_silent(exec_cache.dump_code(key, defs), kc):
+        exec_cache.put(key, outputs)
+
+def execute_many(cells: list[tuple[str, int, str | None, set[str], bool]], kc: KernelClient, queue: asyncio.Queue, loop: asyncio.EventLoop):
+    # one after the other, later cells read what earlier ones define
+    for cell in cells:
+        run_cell(cell, kc, queue, loop)
 
 def prepare_query(convs: list[mytypes.Message], query: str) -> list[dict[str,str]]:
     PROMPT = """
@@ -145,6 +217,7 @@ def prepare_query(convs: list[mytypes.Message], query: str) -> list[dict[str,str
         content = []
         for msg in group:
             if msg.type == "code":
+                msg.pack_output()
                 content.append({"code": msg.content, "outputs": msg.output})
             elif msg.type == "text":
                 content.append(msg.content)
@@ -158,43 +231,29 @@ def prepare_query(convs: list[mytypes.Message], query: str) -> list[dict[str,str
 @app.post("/chats")
 async def create_chat():
     chat_id = str(uuid4())
-    chat_path = Path(f"chats/{chat_id}.json")
-    with chat_path.open("w") as f:
-        json.dump({"messages": []}, f)
+    chatstore.write_chat(chat_id, [])
     return {"id": chat_id, "messages": []}
 
-def get_chat(chat_id: str):
-    chat_path = Path(f"chats/{chat_id}.json")
-    if not chat_path.is_file():
-        return None
-    
-    with chat_path.open() as f:
-        chat = json.load(f)
-
-    chat["id"] = chat_id
-    return chat
-    
 @app.get("/chats/{chat_id}")
-async def get_chat_route(chat_id: str):
-    chat = get_chat(chat_id)
-    if chat is None:
+async def get_chat_route(
+    chat_id: str,
+    start: int | None = Query(None, ge=0),
+    limit: int = Query(50, ge=1, le=1000),
+    meta_only: bool = False,
+):
+    """
+    Without start, the whole chat streamed from disk. With start, a window of cells: metadata
+    (plus total) first, and bodies unless meta_only.
+    """
+    if start is None:
+        if not chatstore.chat_path(chat_id).is_file():
+            raise HTTPException(404)
+        return StreamingResponse(chatstore.stream_chat(chat_id), media_type="application/json")
+
+    body = await asyncio.to_thread(chatstore.read_window, chat_id, start, limit, meta_only)
+    if body is None:
         raise HTTPException(404)
-    
-    return chat
-
-def write_chat(chat_id: str, messages: list[mytypes.Message]):
-    chat_path = Path(f"chats/{chat_id}.json")
-    with NamedTemporaryFile("w", delete_on_close=False) as f:
-        json.dump({"messages": [m.model_dump() for m in messages]}, f, indent=2, ensure_ascii=False)
-        f.close()
-        shutil.copy2(f.name, chat_path)        
-
-def to_messages(msgs: list[dict]) -> list[mytypes.Message]:
-    result = []
-    for msg in msgs:
-        cls = mytypes.CodeMessage if msg["type"] == "code" else mytypes.Message
-        result.append(cls.model_validate(msg))
-    return result
+    return Response(body, media_type="application/json")
 
 def lsp_read(queue: asyncio.Queue, stdout):
     for msg in lsp.reader(stdout):
@@ -209,7 +268,19 @@ def lsp_read(queue: asyncio.Queue, stdout):
 
 @app.websocket("/ws/{chat_id}/lsp")
 async def websocket_ls(ws: WebSocket, chat_id: str):
-    await ws.accept()
+    # the language server runs next to the chat's session, on the worker owning it
+    joined = await join(ws, chat_id, "/lsp")
+    if joined is None:
+        return
+    session, out = joined
+
+    async def close_on_loss():
+        # chat messages are for the chat's own connections
+        while await out.get() is not None:
+            pass
+        await ws.close(code=1012)
+
+    loss = asyncio.create_task(close_on_loss())
     __file__
     if chat_id not in active_lsp:
         proc = lsp.create_proc()
@@ -223,6 +294,7 @@ async def websocket_ls(ws: WebSocket, chat_id: str):
     t = threading.Thread(target=lsp_read, args=(q, proc.stdout), daemon=True)
     t.start()
     try:
+        await ws.accept()
         while True:
             done, _ = await asyncio.wait(
                 {
@@ -250,6 +322,8 @@ async def websocket_ls(ws: WebSocket, chat_id: str):
                     # from LS → send to fe, which will parse what kind of thing it is and call something on monaco appropriately
                     # await ws.send_json(msg)
     finally:
+        loss.cancel()
+        session.unsubscribe(out)
         count, proc, q = active_lsp[chat_id]
         if count == 1:
             proc.kill()
@@ -258,100 +332,425 @@ async def websocket_ls(ws: WebSocket, chat_id: str):
             active_lsp[chat_id] = [count-1, proc, q]
 
 
+class ChatSession:
+    """
+    A chat owned by this worker: one kernel, conversation and chat file writer shared by all the
+    connections to it. Lives while it has connections and its lease in the registry is current.
+    """
+    def __init__(self, chat_id: str, conversation: list[mytypes.Message], lease: sessions.Lease):
+        self.chat_id = chat_id
+        self.conversation = conversation
+        self.lease = lease
+        self.lost = False
+        # ids used to restart at 0 with every connection, the graph needs them unique and in notebook order
+        self.renumbered = any(a.id >= b.id for a, b in zip(conversation, conversation[1:]))
+        if self.renumbered:
+            for i, m in enumerate(conversation):
+                m.id = i
+                m.saved = None
+        # every loaded cell is stale, nothing ran on the new kernel yet
+        self.graph = deps.DepGraph()
+        for m in conversation:
+            if m.type == mytypes.MessageType.CODE:
+                self.graph.add(m.id, m.content, stale=True)
+        # cells that haven't run on this kernel, only their re-runs may restore from the execution cache
+        self.restorable = set(self.graph.cells)
+        self.count = max((m.id for m in conversation), default=-1) + 1
+        self.queue = asyncio.Queue()
+        self.subscribers: set[asyncio.Queue] = set()
+        self.km = KernelManager()
+        # the kernel channels are read by whoever runs a cell, one thread keeps cells in order and
+        # their outputs from being read by another
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.tasks: list[asyncio.Task] = []
+        self.closing: asyncio.Task | None = None
+        # one save at a time, each copies the cells that didn't change out of the file the previous one wrote
+        self.saving = asyncio.Lock()
+
+    async def start(self):
+        def start_kernel():
+            self.km.start_kernel()
+            kc = self.km.client()
+            kc.start_channels()
+            kc.wait_for_ready()
+            return kc
+        if self.renumbered or not await asyncio.to_thread(chatstore.is_line_format, self.chat_id):
+            # rewritten now, under the lease: windows read from disk have to agree with the ids connections
+            # get from now on, and files in the older format are converted
+            await self.save(exclusive=True)
+        self.loop = asyncio.get_running_loop()
+        self.kc = await asyncio.to_thread(start_kernel)
+        self.tasks = [
+            asyncio.create_task(self.dispatch()),
+            asyncio.create_task(self.save_periodically()),
+            asyncio.create_task(self.renew_lease()),
+        ]
+
+    def subscribe(self) -> asyncio.Queue:
+        out = asyncio.Queue()
+        self.subscribers.add(out)
+        return out
+
+    def unsubscribe(self, out: asyncio.Queue):
+        self.subscribers.discard(out)
+        if not self.subscribers:
+            self.retire()
+
+    def retire(self):
+        """stops handing the session to new connections, and closes it once the current ones are gone"""
+        task = active_chats.get(self.chat_id)
+        if task is not None and task.done() and task.result() is self:
+            del active_chats[self.chat_id]
+        if not self.subscribers and self.closing is None:
+            # a new session for the chat waits for this one to save and release the lease
+            self.closing = asyncio.create_task(self.close())
+            closing[self.chat_id] = self.closing
+
+    async def close(self):
+        try:
+            for task in self.tasks:
+                task.cancel()
+            if not self.lost:
+                await self.save()
+                await asyncio.to_thread(registry.release, self.lease)
+        except sessions.LeaseLost:
+            pass
+        except sessions.RegistryUnavailable as e:
+            print(f"ERROR: final save of chat {self.chat_id} failed: {e}")
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.kc.stop_channels()
+            await asyncio.to_thread(self.km.shutdown_kernel, now=True)
+            if closing.get(self.chat_id) is self.closing:
+                del closing[self.chat_id]
+
+    def lose(self):
+        """
+        Another worker owns the chat now, or may by the time the lease runs out. Connections are closed so
+        clients reconnect through the owner.
+        """
+        print(f"ERROR: lost the lease on chat {self.chat_id}")
+        self.lost = True
+        for out in self.subscribers:
+            out.put_nowait(None)
+        self.retire()
+
+    async def save(self, exclusive: bool = False):
+        """exclusive when nothing else can touch the conversation yet, encoding every cell can leave the loop too"""
+        async with self.saving:
+            if exclusive:
+                plan = await asyncio.to_thread(chatstore.encode, self.conversation)
+            else:
+                plan = chatstore.encode(self.conversation)
+            def fenced_write():
+                # the fence blocks every worker's registry calls, only the renames happen inside it
+                staged, spans = chatstore.stage(self.chat_id, plan)
+                try:
+                    with registry.fence(self.lease):
+                        chatstore.commit(self.chat_id, staged)
+                finally:
+                    chatstore.discard(staged)
+                return spans
+            write = asyncio.ensure_future(asyncio.to_thread(fenced_write))
+            try:
+                await asyncio.shield(write)
+            finally:
+                # a cancelled save (close cancels save_periodically) still holds the lock until its write is over,
+                # the final save would otherwise race it and could be replaced by an older file
+                await asyncio.wait([write])
+                chatstore.saved(self.conversation, plan, None if write.exception() else write.result())
+
+    async def save_periodically(self):
+        try:
+            while True:
+                await asyncio.sleep(10)
+                try:
+                    await self.save()
+                except sessions.RegistryUnavailable as e:
+                    # nothing was written, the next save has everything
+                    print(f"ERROR: saving chat {self.chat_id}: {e}")
+        except sessions.LeaseLost:
+            self.lose()
+
+    async def renew_lease(self):
+        try:
+            while True:
+                await asyncio.sleep(sessions.LEASE_TTL / 3)
+                try:
+                    self.lease = await asyncio.to_thread(registry.renew, self.lease, sessions.LEASE_TTL)
+                except sessions.RegistryUnavailable as e:
+                    print(f"ERROR: renewing the lease on chat {self.chat_id}: {e}")
+                    # retried next round, unless the lease runs out before: then another worker may take
+                    # the chat without this one knowing
+                    if time.time() + sessions.LEASE_TTL / 3 >= self.lease.expires:
+                        self.lose()
+                        return
+        except sessions.LeaseLost:
+            self.lose()
+
+    async def dispatch(self):
+        # the conversation is updated once here, then every connection gets the message
+        while True:
+            msg = await self.queue.get()
+            if msg.get("result", "") == "code execution":
+                to_update = [c for c in self.conversation if c.id == msg["id"]]
+                if len(to_update) != 1:
+                    print("ERROR: len of items to update for code ex is not 1")
+                else:
+                    to_update = to_update[0]
+                    if msg["type"] == "status": 
+                        if msg["content"] == "busy":
+                            to_update.execution_status = "started"
+                        else:
+                            to_update.execution_status = "done"
+                            self.restorable.discard(to_update.id)
+                        to_update.saved = None
+                    else:
+                        output = {"type": msg["type"], "content": msg["content"]}
+                        if msg.get("restored"):
+                            output["restored"] = True
+                        to_update.add_output(output)
+            for out in self.subscribers:
+                out.put_nowait(msg)
+
+    async def edit(self, req: mytypes.EditReq):
+        to_edit = [c for c in self.conversation if c.id == req.id]
+        if len(to_edit) != 1:
+            await self.queue.put({"result": "not found", "id": req.id})
+            return
+        to_edit = to_edit[0]
+        if req.change.type != to_edit.type:
+            print("ERROR: changing the type of a cell is not supported")
+            return
+
+        to_edit.content = req.change.content
+        to_edit.version += 1
+        to_edit.saved = None
+        await self.queue.put({"result": "edited", "id": req.id, "version": to_edit.version})
+        if to_edit.type == mytypes.MessageType.CODE:
+            newly_stale = self.graph.update(req.id, req.change.content)
+            await self.queue.put({"result": "stale", "ids": sorted(newly_stale)})
+
+    def cache_key(self, cell_id: int, memo: dict[int, str]) -> str | None:
+        node = self.graph.cells[cell_id]
+        # magics and shell escapes have effects outside the namespace, cells defining nothing run for their effects
+        if exec_cache is None or node.magics or not node.defs:
+            return None
+        return self.graph.key(cell_id, memo)
+
+    async def run_stale(self):
+        by_id = {c.id: c for c in self.conversation}
+        memo = {}
+        cells = []
+        for cell_id in self.graph.stale_order():
+            self.graph.scheduled(cell_id)
+            cell = by_id[cell_id]
+            cell.clear_output()
+            cell.execution_status = "pending"
+            await self.queue.put({"result": "cleared", "id": cell_id})
+            cells.append((
+                cell.content, cell_id, self.cache_key(cell_id, memo), self.graph.cells[cell_id].defs,
+                cell_id in self.restorable,
+            ))
+        self.loop.run_in_executor(self.executor, execute_many, cells, self.kc, self.queue, self.loop)
+
+    async def create(self, msg: mytypes.MessageReq, started: set[int]):
+        old_id = msg.id
+        response_id = msg.response_id
+        supersede = msg.supersede
+        msg = mytypes.Message.from_message_req(msg, self.count)
+        self.count += 1
+        if msg.type == mytypes.MessageType.CODE:
+            msg = mytypes.CodeMessage.from_message(msg)
+
+        self.conversation.append(msg)
+        if msg.type == mytypes.MessageType.QUERY:
+            assert isinstance(response_id, str) and response_id
+            resp_id = self.count
+            self.count += 1
+            await ack(response_id, resp_id, self.queue)
+            if supersede:
+                generations.cancel(self.chat_id)
+            task = asyncio.create_task(generate(prepare_query(self.conversation[:-1], msg.content), resp_id, self.queue, self.chat_id))
+            generations.track(self.chat_id, resp_id, task)
+            started.add(resp_id)
+        elif msg.type == mytypes.MessageType.CODE:
+            self.graph.add(msg.id, msg.content)
+            # always executed, cells the user sends are expected to run (and show fresh outputs)
+            cell = (msg.content, msg.id, self.cache_key(msg.id, {}), self.graph.cells[msg.id].defs, False)
+            self.loop.run_in_executor(self.executor, run_cell, cell, self.kc, self.queue, self.loop)
+
+        await ack(old_id, msg.id, self.queue)
+
+registry = sessions.create()
+# chat id -> task opening its session, the result is a ChatSession or, when another worker
+# owns the chat (or it doesn't exist), the owner's lease (or None)
+active_chats: dict[str, asyncio.Task] = {}
+closing: dict[str, asyncio.Task] = {}
+
+async def open_session(chat_id: str) -> ChatSession | sessions.Lease | None:
+    try:
+        if chat_id in closing:
+            await asyncio.wait([closing[chat_id]])
+        lease = await asyncio.to_thread(registry.acquire, chat_id, sessions.WORKER_ADDRESS, sessions.LEASE_TTL)
+        if lease.owner != sessions.WORKER_ADDRESS:
+            active_chats.pop(chat_id, None)
+            return lease
+
+        conversation = await asyncio.to_thread(chatstore.load_messages, chat_id)
+        if conversation is None:
+            await asyncio.to_thread(registry.release, lease)
+            active_chats.pop(chat_id, None)
+            return None
+
+        session = ChatSession(chat_id, conversation, lease)
+        await session.start()
+        return session
+    except BaseException:
+        active_chats.pop(chat_id, None)
+        raise
+
+async def get_session(chat_id: str) -> ChatSession | sessions.Lease | None:
+    if chat_id not in active_chats:
+        active_chats[chat_id] = asyncio.create_task(open_session(chat_id))
+    # shielded, a connection dropping while the kernel starts shouldn't cancel it for the others
+    return await asyncio.shield(active_chats[chat_id])
+
+PROXY_HEADER = "x-session-proxy"
+
+async def proxy(ws: WebSocket, chat_id: str, lease: sessions.Lease, path: str = ""):
+    """relays the connection to the worker owning the chat (path under /ws/{chat_id}), frames go through untouched"""
+    if PROXY_HEADER in ws.headers:
+        # proxied to us but we don't own it either, the lease moved: let the client retry
+        await ws.close(code=1013)
+        return
+
+    url = lease.owner.replace("http", "ws", 1) + f"/ws/{chat_id}{path}"
+    try:
+        upstream = await websockets.connect(
+            url,
+            subprotocols=ws.scope.get("subprotocols") or None,
+            additional_headers={PROXY_HEADER: sessions.WORKER_ADDRESS},
+            max_size=None,
+        )
+    except (OSError, websockets.InvalidHandshake):
+        await ws.close(code=1013)
+        return
+
+    await ws.accept(subprotocol=upstream.subprotocol)
+
+    async def client_to_owner():
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                return
+            await upstream.send(msg["bytes"] if msg.get("bytes") is not None else msg["text"])
+
+    async def owner_to_client():
+        try:
+            async for frame in upstream:
+                if isinstance(frame, bytes):
+                    await ws.send_bytes(frame)
+                else:
+                    await ws.send_text(frame)
+        except websockets.ConnectionClosed:
+            pass
+        # the owner went away without a close frame, tell the client to reconnect
+        code = upstream.close_code if upstream.close_code not in (None, 1005, 1006) else 1012
+        await ws.close(code=code)
+
+    tasks = [asyncio.create_task(client_to_owner()), asyncio.create_task(owner_to_client())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await upstream.close()
+
+async def join(ws: WebSocket, chat_id: str, path: str = "") -> tuple[ChatSession, asyncio.Queue] | None:
+    """
+    The session of the chat, subscribed to, when this worker owns it. None when there's nothing left to do
+    with the connection: proxied to the owner (at path), closed, or the chat doesn't exist.
+    """
+    while True:
+        try:
+            session = await get_session(chat_id)
+        except sessions.RegistryUnavailable:
+            await ws.close(code=1013)
+            return None
+        if session is None:
+            return None
+        if isinstance(session, sessions.Lease):
+            await proxy(ws, chat_id, session, path)
+            return None
+
+        # subscribed before anything awaits, a session with a subscriber doesn't close
+        out = session.subscribe()
+        if session.closing is None and not session.lost:
+            return session, out
+        # retired while this connection waited for it, the next get_session opens the chat again
+        session.subscribers.discard(out)
+
 @app.websocket("/ws/{chat_id}")
 async def websocket_endpoint(ws: WebSocket, chat_id: str):
-    chat = get_chat(chat_id)
-    if chat is None:
+    joined = await join(ws, chat_id)
+    if joined is None:
         return
+    session, out = joined
 
-    conversation: list[mytypes.Message] = to_messages(chat["messages"])
-
-    await ws.accept()
-    loop = asyncio.get_running_loop()
-    queue = asyncio.Queue()
-    count = 0
-    km = KernelManager()
-    km.start_kernel()
-    kc = km.client()
-    kc.start_channels()
-    kc.wait_for_ready()
-    async def save_chat():
-        while True:
-            await asyncio.sleep(10)
-            write_chat(chat_id, conversation)
+    protocol, subprotocol = wire.negotiate(ws)
+    # generations this connection started, other connections to the chat keep theirs on disconnect
+    started: set[int] = set()
 
     async def read_ws():
-        nonlocal count
         try:
             while True:
-                json_str = await ws.receive_text()
-                msg = mytypes.MessageReq.model_validate_json(json_str)
+                frame = await wire.receive(ws, protocol)
+                if isinstance(frame, bytes):
+                    msg = mytypes.RequestAdapter.validate_python(wire.decode(frame))
+                else:
+                    msg = mytypes.RequestAdapter.validate_json(frame)
+                if isinstance(msg, mytypes.EditReq):
+                    await session.edit(msg)
+                    continue
+                if isinstance(msg, mytypes.RunStaleReq):
+                    await session.run_stale()
+                    continue
+                if isinstance(msg, mytypes.StopReq):
+                    generations.cancel(chat_id, None if msg.id is None else {msg.id})
+                    continue
                 if msg.type == mytypes.MessageType.LLM:
                     print("ERROR: received msg with type LLM")
                     continue
-
-                old_id = msg.id
-                response_id = msg.response_id
-                msg = mytypes.Message.from_message_req(msg, count)
-                count += 1
-                if msg.type == mytypes.MessageType.CODE:
-                    msg = mytypes.CodeMessage.from_message(msg)
-
-                conversation.append(msg)
-                if msg.type == mytypes.MessageType.QUERY:
-                    # with open("tmp.json", "w") as f:
-                    #     json.dump(
-                    #         [m.model_dump() for m in conversation], 
-                    #         f,
-                    #         indent=2,
-                    #         ensure_ascii=False
-                    #     )
-
-                    assert isinstance(response_id, str) and response_id
-                    resp_id = count
-                    count += 1
-                    await ack(response_id, resp_id, queue)
-                    asyncio.create_task(generate(prepare_query(conversation[:-1], msg.content), resp_id, queue))
-                elif msg.type == mytypes.MessageType.CODE:
-                    asyncio.create_task(
-                        asyncio.to_thread(execute, msg.content, msg.id, kc, queue, loop)
-                    )
-                        
-                await ack(old_id, msg.id, queue)
+                await session.create(msg, started)
         except WebSocketDisconnect:
-            kc.stop_channels()
-            km.shutdown_kernel(now=True)
+            pass
 
     async def write_ws():
         try:
             while True:
-                msg = await queue.get()
-                if msg.get("result", "") == "code execution":
-                    to_update = [c for c in conversation if c.id == msg["id"]]
-                    if len(to_update) != 1:
-                        print("ERROR: len of items to update for code ex is not 1")
-                    else:
-                        to_update = to_update[0]
-                        if msg["type"] == "status": 
-                            if msg["content"] == "busy":
-                                to_update.execution_status = "started"
-                            else:
-                                to_update.execution_status = "done"
-                        else:
-                            to_update.output.append({"type": msg["type"], "content": msg["content"]})
-                await ws.send_json(msg)
+                msg = await out.get()
+                if msg is None:
+                    # service restart, the client reconnects and lands on the new owner
+                    await ws.close(code=1012)
+                    return
+                await wire.send(ws, msg, protocol)
         except WebSocketDisconnect:
-            kc.stop_channels()
-            km.shutdown_kernel(now=True)
-
-    reader = asyncio.create_task(read_ws())
-    writer = asyncio.create_task(write_ws())
-    saver = asyncio.create_task(save_chat())
+            pass
 
-    done, pending = await asyncio.wait(
-        [reader, writer, saver],
-        return_when=asyncio.FIRST_COMPLETED,
-    )
+    try:
+        await ws.accept(subprotocol=subprotocol)
+        reader = asyncio.create_task(read_ws())
+        writer = asyncio.create_task(write_ws())
+        done, pending = await asyncio.wait(
+            [reader, writer],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in pending:
+            task.cancel()
+    finally:
+        generations.cancel(chat_id, started)
+        session.unsubscribe(out)
 
 prompt = """
 Hi, the other day something that looked very similar to a jupyter notebook, but with AI integration: any block could optionally be an 
@@ -1,6 +1,7 @@
 from enum import StrEnum
-from pydantic import BaseModel
-from typing import Literal
+from dataclasses import dataclass, field
+from pydantic import BaseModel, Discriminator, Field, Tag, TypeAdapter
+from typing import Literal, Annotated
 
 class MessageType(StrEnum):
     CODE = "code"
@@ -18,24 +19,110 @@ class MessageBase(BaseModel):
     content: str
 
 class MessageReq(MessageBase):
+    request_type: Literal["create"] = "create"
     id: str
     response_id: str | None = None
+    # cancel the chat generations still running when this query starts a new one
+    supersede: bool = False
 
-class Message(MessageBase):
+class EditChange(BaseModel):
+    content: str
+    type: MessageType
+
+class EditReq(BaseModel):
+    request_type: Literal["edit"]
+    id: int
+    change: EditChange
+
+class RunStaleReq(BaseModel):
+    request_type: Literal["run_stale"]
+
+class StopReq(BaseModel):
+    request_type: Literal["stop"]
+    id: int | None = None # every generation of the chat if None
+
+def _request_type(v) -> str:
+    # older clients don't send request_type on creation
+    if isinstance(v, dict):
+        return v.get("request_type", "create")
+    return getattr(v, "request_type", "create")
+
+Request = Annotated[
+    Annotated[MessageReq, Tag("create")]
+    | Annotated[EditReq, Tag("edit")]
+    | Annotated[RunStaleReq, Tag("run_stale")]
+    | Annotated[StopReq, Tag("stop")],
+    Discriminator(_request_type),
+]
+RequestAdapter = TypeAdapter(Request)
+
+# notebook cells are plain slotted dataclasses, a pydantic model per cell dominated load and save time
+# of big notebooks. Cells are validated one at a time through CellAdapter
+@dataclass(slots=True, kw_only=True)
+class Message:
+    type: MessageType
+    content: str
     version: int = 1
     id: int
+    # where the cell is in the chat file (see chatstore.encode), reset on every change so a save only encodes
+    # the cells that changed and copies the others
+    saved: Annotated[tuple | None, Field(exclude=True)] = field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def from_message_req(cls, msg: MessageReq, id: int):
         return cls(id=id, type=msg.type, content=msg.content)
 
+@dataclass(slots=True, kw_only=True)
 class CodeMessage(Message):
     type: Literal["code"]
-    output: list
-    execution_status: str
+    output: list = field(default_factory=list)
+    execution_status: str = "pending"
+    # text of the last output while its stream goes on, joined into it by pack_output. Never serialized
+    stream_chunks: Annotated[list[str], Field(exclude=True)] = field(default_factory=list, init=False, repr=False, compare=False)
 
     @classmethod
     def from_message(cls, msg: Message):
         assert msg.type == "code", "CodeMessage should be built from msgs with type code"
-        return cls(**msg.model_dump(), output=[], execution_status="pending")
+        return cls(type=msg.type, content=msg.content, version=msg.version, id=msg.id)
+
+    def add_output(self, output: dict):
+        # consecutive chunks of the same stream are packed into one segment, a print in a loop
+        # would otherwise store (and reload) one dict per line. Chunks are only collected here,
+        # concatenating them one by one copies the whole segment every time
+        if output["type"] == "stream" and self.output:
+            last = self.output[-1]
+            if (last["type"] == "stream" and last["content"]["name"] == output["content"]["name"]
+                    and last.get("restored") == output.get("restored")):
+                if not self.stream_chunks:
+                    self.stream_chunks.append(last["content"]["text"])
+                self.stream_chunks.append(output["content"]["text"])
+                self.saved = None
+                return
+        self.pack_output()
+        self.output.append(output)
+        self.saved = None
+
+    def pack_output(self):
+        """joins the chunks of the open stream segment, call it before reading output"""
+        if self.stream_chunks:
+            last = self.output[-1]
+            last["content"] = {**last["content"], "text": "".join(self.stream_chunks)}
+            self.stream_chunks = []
+
+    def clear_output(self):
+        self.output = []
+        self.stream_chunks = []
+        self.saved = None
+
+def _cell_type(v) -> str:
+    if isinstance(v, dict):
+        return "code" if v.get("type") == "code" else "other"
+    return "code" if isinstance(v, CodeMessage) else "other"
+
+Cell = Annotated[
+    Annotated[CodeMessage, Tag("code")] | Annotated[Message, Tag("other")],
+    Discriminator(_cell_type),
+]
 
+# built once, validating through it costs about the same as a pydantic pass over the whole notebook
+CellAdapter = TypeAdapter(Cell)
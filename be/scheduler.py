@@ -0,0 +1,153 @@
+import asyncio
+import time
+from collections import deque
+
+def estimate_tokens(text: str) -> int:
+    # close enough for rate limiting, ~4 chars per token
+    return max(1, len(text) // 4)
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens: int) -> float:
+        """seconds until tokens can be taken, requests bigger than the bucket wait for it to be full"""
+        self._refill()
+        missing = min(tokens, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, tokens: int):
+        # streamed tokens are charged after the fact, so this can go negative and delay later requests
+        self._refill()
+        self.tokens -= tokens
+
+class Slot:
+    """held for the whole generation, wait is how long the request sat in the queue"""
+    def __init__(self, scheduler: "GenerationScheduler", chat_id: str, tokens: int):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.tokens = tokens
+        self.wait = 0.0
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        await self.scheduler._acquire(self.chat_id, self.tokens)
+        self.wait = time.monotonic() - start
+        return self
+
+    async def __aexit__(self, *_exc):
+        self.scheduler._release()
+
+    def charge(self, tokens: int):
+        if self.scheduler.bucket is not None:
+            self.scheduler.bucket.take(tokens)
+
+class GenerationScheduler:
+    """
+    Limits concurrent LLM generations and tokens per minute across all chats of the process.
+    Waiting requests are served by chat, least recently served first, so one chat can't starve the others.
+    In-flight generations are tracked per chat so they can be cancelled on stop, supersede or disconnect.
+    """
+    def __init__(self, max_concurrent: int, tokens_per_minute: int = 0):
+        self.max_concurrent = max_concurrent
+        self.bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.running = 0
+        self.waiting: dict[str, deque[tuple[asyncio.Future, int]]] = {}
+        self.last_served: dict[str, int] = {}
+        self._served = 0
+        self.inflight: dict[str, dict[int, asyncio.Task]] = {}
+        self._timer: asyncio.TimerHandle | None = None
+
+    def slot(self, chat_id: str, tokens: int) -> Slot:
+        return Slot(self, chat_id, tokens)
+
+    def track(self, chat_id: str, msg_id: int, task: asyncio.Task):
+        tasks = self.inflight.setdefault(chat_id, {})
+        tasks[msg_id] = task
+
+        def done(_task):
+            tasks.pop(msg_id, None)
+            if not tasks and self.inflight.get(chat_id) is tasks:
+                del self.inflight[chat_id]
+                if chat_id not in self.waiting:
+                    self.last_served.pop(chat_id, None)
+        task.add_done_callback(done)
+
+    def cancel(self, chat_id: str, msg_ids: set[int] | None = None) -> list[int]:
+        """cancels the chat generations in msg_ids (all of them if None), returns the cancelled ids"""
+        cancelled = []
+        for msg_id, task in list(self.inflight.get(chat_id, {}).items()):
+            if msg_ids is None or msg_id in msg_ids:
+                task.cancel()
+                cancelled.append(msg_id)
+        return cancelled
+
+    async def _acquire(self, chat_id: str, tokens: int):
+        fut = asyncio.get_running_loop().create_future()
+        entry = (fut, tokens)
+        self.waiting.setdefault(chat_id, deque()).append(entry)
+        self._dispatch()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # granted right before the cancellation, give the slot back
+                self._release()
+            else:
+                self._forget(chat_id, entry)
+            raise
+
+    def _forget(self, chat_id: str, entry: tuple[asyncio.Future, int]):
+        waiters = self.waiting.get(chat_id)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(entry)
+        except ValueError:
+            pass
+        if not waiters:
+            del self.waiting[chat_id]
+
+    def _release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and self.waiting:
+            chat_id = min(self.waiting, key=lambda c: self.last_served.get(c, 0))
+            waiters = self.waiting[chat_id]
+            fut, tokens = waiters[0]
+            if fut.done():
+                self._forget(chat_id, waiters[0])
+                continue
+            if self.bucket is not None:
+                delay = self.bucket.delay(tokens)
+                if delay > 0:
+                    self._retry_in(delay)
+                    return
+                self.bucket.take(tokens)
+
+            waiters.popleft()
+            if not waiters:
+                del self.waiting[chat_id]
+            self._served += 1
+            self.last_served[chat_id] = self._served
+            self.running += 1
+            fut.set_result(None)
+
+    def _retry_in(self, delay: float):
+        if self._timer is not None:
+            return
+
+        def retry():
+            self._timer = None
+            self._dispatch()
+        self._timer = asyncio.get_running_loop().call_later(delay, retry)
@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import sys
+import time
+from abc import ABC, abstractmethod
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+def _server_option(name: str) -> str | None:
+    # uvicorn (and fastapi run) take options on the command line or as UVICORN_* variables, the worker
+    # processes it spawns get the supervisor's argv
+    for i, arg in enumerate(sys.argv):
+        if arg == f"--{name}" and i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+        if arg.startswith(f"--{name}="):
+            return arg.split("=", 1)[1]
+    return os.getenv(f"UVICORN_{name.upper()}")
+
+# workers of one server share its port and environment, so they'd all claim chats under one address
+if int(_server_option("workers") or os.getenv("WEB_CONCURRENCY") or 1) > 1:
+    raise RuntimeError("--workers runs several workers under one address, run one uvicorn per port instead")
+
+# how other workers reach this one, also its identity in the registry. Every worker process needs its own,
+# e.g. one uvicorn per port behind the load balancer. Defaults to the port on localhost, distinct per worker
+# of one host (which is what the SQLite registry covers)
+WORKER_ADDRESS = os.getenv("WORKER_ADDRESS") or f"http://127.0.0.1:{_server_option('port') or 8000}"
+LEASE_TTL = float(os.getenv("SESSION_LEASE_TTL", "30"))
+
+class LeaseLost(Exception):
+    pass
+
+class RegistryUnavailable(Exception):
+    """the registry couldn't be reached (or was locked for too long), the lease may or may not still be ours"""
+
+@dataclass(slots=True)
+class Lease:
+    chat_id: str
+    owner: str # worker address
+    token: int # grows with every new owner, stale writers are fenced by it
+    expires: float
+
+class SessionRegistry(ABC):
+    """
+    Maps each chat to the worker that owns its session (kernel, conversation, chat file writes).
+    Blocking, call it from a thread.
+    """
+    @abstractmethod
+    def acquire(self, chat_id: str, owner: str, ttl: float) -> Lease:
+        """takes the lease if it's free, expired or already ours, otherwise returns the current owner's"""
+
+    @abstractmethod
+    def renew(self, lease: Lease, ttl: float) -> Lease:
+        """raises LeaseLost if someone else took the chat"""
+
+    @abstractmethod
+    def release(self, lease: Lease):
+        pass
+
+    @abstractmethod
+    def fence(self, lease: Lease) -> AbstractContextManager[None]:
+        """
+        Context manager, raises LeaseLost unless lease is current and keeps it so until exit.
+        It blocks the other workers, keep the fenced block short (e.g. an os.replace of a file written before).
+        """
+
+class SqliteRegistry(SessionRegistry):
+    """Stand-in good for the workers of one host, the database lock doubles as the write fence"""
+    def __init__(self, path: str):
+        self.path = path
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(chat_id TEXT PRIMARY KEY, owner TEXT NOT NULL, token INTEGER NOT NULL, expires REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection per call, calls come from whatever thread asyncio.to_thread picks
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        try:
+            conn = self._connect()
+            try:
+                # takes the write lock right away, so read-then-write can't interleave across workers
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            raise RegistryUnavailable(str(e)) from e
+
+    def acquire(self, chat_id: str, owner: str, ttl: float) -> Lease:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT owner, token, expires FROM leases WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is not None and row[0] != owner and row[2] > now:
+                return Lease(chat_id, *row)
+
+            token = 1 if row is None else row[1] + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (chat_id, owner, token, expires) VALUES (?, ?, ?, ?)",
+                (chat_id, owner, token, now + ttl),
+            )
+            return Lease(chat_id, owner, token, now + ttl)
+
+    def renew(self, lease: Lease, ttl: float) -> Lease:
+        expires = time.time() + ttl
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE leases SET expires = ? WHERE chat_id = ? AND owner = ? AND token = ?",
+                (expires, lease.chat_id, lease.owner, lease.token),
+            )
+            if cur.rowcount != 1:
+                raise LeaseLost(lease.chat_id)
+        return Lease(lease.chat_id, lease.owner, lease.token, expires)
+
+    def release(self, lease: Lease):
+        # expired rather than deleted, the next owner's token keeps growing
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE leases SET expires = 0 WHERE chat_id = ? AND owner = ? AND token = ?",
+                (lease.chat_id, lease.owner, lease.token),
+            )
+
+    @contextmanager
+    def fence(self, lease: Lease) -> Iterator[None]:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT owner, token FROM leases WHERE chat_id = ?", (lease.chat_id,)).fetchone()
+            if row != (lease.owner, lease.token):
+                raise LeaseLost(lease.chat_id)
+            yield
+
+def create() -> SessionRegistry:
+    return SqliteRegistry(os.getenv("SESSION_DB", "sessions.db"))
@@ -0,0 +1,95 @@
+import base64
+import json
+import struct
+from typing import Literal
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
+
+# subprotocol names offered by the client in Sec-WebSocket-Protocol
+JSON_PROTOCOL = "nb.json.v1"
+MSGPACK_PROTOCOL = "nb.msgpack.v1"
+
+# first byte of every binary frame
+FRAME_MSGPACK = 0x00
+FRAME_IMAGE = 0x01
+
+# mime types that are sent as raw bytes instead of base64 strings
+BINARY_MIMES = ["image/png"]
+
+# kind (1 byte) + header length (4 bytes, big endian)
+_PREFIX = struct.Struct(">BI")
+
+Protocol = Literal["json", "msgpack"]
+
+def negotiate(ws: WebSocket) -> tuple[Protocol, str | None]:
+    """
+    Picks the wire protocol from the subprotocols offered by the client.
+    Returns the protocol and the subprotocol name to echo back in accept (None for old clients).
+    """
+    offered = ws.scope.get("subprotocols", [])
+    if MSGPACK_PROTOCOL in offered:
+        return "msgpack", MSGPACK_PROTOCOL
+    if JSON_PROTOCOL in offered:
+        return "json", JSON_PROTOCOL
+    return "json", None
+
+def image_payload(msg: dict) -> bytes | None:
+    """returns the decoded image if msg is a code execution output carrying one"""
+    if msg.get("type") != "data":
+        return None
+    content = msg.get("content", {})
+    if content.get("type") not in BINARY_MIMES:
+        return None
+    return base64.b64decode(content["data"])
+
+def encode_image(msg: dict, data: bytes) -> bytes:
+    # header is the msg without the image data, the fe puts it back as a Blob
+    header = {k: v for k, v in msg.items() if k != "content"}
+    header["mime"] = msg["content"]["type"]
+    packed = msgpack.packb(header)
+    return _PREFIX.pack(FRAME_IMAGE, len(packed)) + packed + data
+
+def encode_msgpack(msg: dict) -> bytes:
+    return bytes([FRAME_MSGPACK]) + msgpack.packb(msg)
+
+def encode(msg: dict, protocol: Protocol) -> str | bytes:
+    if protocol == "json":
+        return json.dumps(msg)
+
+    data = image_payload(msg)
+    if data is not None:
+        return encode_image(msg, data)
+    return encode_msgpack(msg)
+
+def decode(frame: bytes) -> dict:
+    """inverse of encode for binary frames, images come back base64 encoded like in json"""
+    kind = frame[0]
+    if kind == FRAME_MSGPACK:
+        return msgpack.unpackb(frame[1:])
+    if kind == FRAME_IMAGE:
+        _, header_len = _PREFIX.unpack_from(frame)
+        start = _PREFIX.size
+        msg = msgpack.unpackb(frame[start:start+header_len])
+        data = frame[start+header_len:]
+        msg["content"] = {"type": msg.pop("mime"), "data": base64.b64encode(data).decode()}
+        return msg
+    raise ValueError(f"unknown frame kind {kind}")
+
+async def send(ws: WebSocket, msg: dict, protocol: Protocol):
+    out = encode(msg, protocol)
+    if isinstance(out, bytes):
+        await ws.send_bytes(out)
+    else:
+        await ws.send_text(out)
+
+async def receive(ws: WebSocket, protocol: Protocol) -> str | bytes:
+    """
+    Returns the raw inbound frame: clients on the msgpack protocol may still send text frames
+    with json, so the caller validates both.
+    """
+    msg = await ws.receive()
+    if msg["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(msg.get("code", 1000))
+    if msg.get("bytes") is not None:
+        return msg["bytes"]
+    return msg["text"]
@@ -6,6 +6,23 @@ export type Chat = {
   messages: Message[]
 }
 
+export type CellMeta = {
+  id: number
+  type: MessageType
+  version: number
+  execution_status?: ExecutionStatus // code cells only
+  outputs?: number // code cells only
+}
+
+// GET /chats/{id}?start=&limit=[&meta_only=true]
+export type ChatWindow = {
+  id: string
+  total: number
+  start: number
+  cells: CellMeta[]
+  messages?: Message[]
+}
+
 type BaseMessage = {
   author: string
   content: string
@@ -81,7 +98,16 @@ type DeleteRequest = {
   id: number,
 }
 
-// type Request = CreateRequest | EditRequest | DeleteRequest
+type RunStaleRequest = {
+  request_type: "run_stale"
+}
+
+type StopRequest = {
+  request_type: "stop",
+  id?: number // every generation of the chat if missing
+}
+
+// type Request = CreateRequest | EditRequest | DeleteRequest | RunStaleRequest | StopRequest
 
 type NotFoundResponse = {
   result: "not found",
@@ -93,6 +119,22 @@ type CreationSuccessResponse = {
   id: number
 }
 
+type StaleResponse = {
+  result: "stale",
+  ids: number[] // code cells whose inputs changed since they last ran
+}
+
+type GenerationStartedResponse = {
+  result: "generation started",
+  id: number,
+  queue_wait: number // seconds
+}
+
+type GenerationCancelledResponse = {
+  result: "generation cancelled",
+  id: number
+}
+
 type GenerationFailedResponse = {
   result: "generation failed",
   id: number